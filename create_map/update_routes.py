@@ -1,9 +1,11 @@
 import os
 import json
-import gpxpy
+import itertools
+import numpy as np
 import geopandas as gpd
-import pandas as pd
-from shapely.geometry import LineString
+from shapely import linestrings, union_all, line_merge, simplify, snap, buffer, get_parts, STRtree
+from lxml import etree
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from garminconnect import Garmin
 from pathlib import Path
 from datetime import datetime, date
@@ -18,7 +20,8 @@ PASSWORD = os.getenv("GARMIN_PASS")
 DATA_DIR = Path(os.getenv("DATA_DIR"))  # for temporry files (can get large)
 SAVE_DIR = Path(os.getenv("SAVE_DIR"))
 
-EXISTING = SAVE_DIR / "all_routes.geojson"
+EXISTING = SAVE_DIR / "all_routes.parquet"  # canonical dataset, binary coords
+GEOJSON = SAVE_DIR / "all_routes.geojson"   # re-emitted for the Leaflet map
 INFO_FILE = SAVE_DIR / "map_info.json"
 TMP_DIR = DATA_DIR / "tmp_gpx"
 
@@ -39,16 +42,67 @@ def get_last_update():
             return datetime.fromisoformat(info["last_update"])
     return datetime(2017, 1, 1)
 
+def _stream_gpx(gpx_file):
+    """Stream the <trkseg>s of a GPX file as (N, 2) lon/lat float arrays."""
+    segments = []
+    for _, seg in etree.iterparse(str(gpx_file), events=("end",), tag="{*}trkseg"):
+        pts = seg.findall("{*}trkpt")
+        arr = np.empty((len(pts), 2), dtype=np.float64)
+        for i, p in enumerate(pts):
+            arr[i, 0] = float(p.get("lon"))
+            arr[i, 1] = float(p.get("lat"))
+        np.round(arr, 5, out=arr)  # ~1 m precision, keeps the GeoJSON small
+        seg.clear()  # free the element tree as we go
+        segments.append(arr)
+    return segments
+
+def load_merged_geom(rebuilding=False):
+    """Load the persisted merged geometry, or None on the very first run."""
+    if EXISTING.exists():
+        return gpd.read_parquet(EXISTING).geometry.iloc[0]
+    if GEOJSON.exists() and not rebuilding:
+        # legacy state: GeoJSON history but no parquet store yet. Bail out
+        # instead of rebuilding the served map from one batch (the old
+        # polygon geometry would not union with the line representation)
+        raise RuntimeError(
+            f"{GEOJSON} exists but {EXISTING} does not — run "
+            "import_historical_gpx over the full GPX archive to rebuild "
+            "the parquet store before updating."
+        )
+    return None
+
+def prune_covered(lines, merged_geom, tolerance=0.00005):
+    """Drop lines the merged geometry already covers (cheap STRtree lookup),
+    so only routes adding new geometry reach the union stage."""
+    if merged_geom is None:
+        return list(lines)
+    # test against a thin buffer of the merged map — exact line-on-line
+    # coverage would never match noisy GPS traces
+    tree = STRtree(get_parts(buffer(merged_geom, tolerance)))
+    return [l for l in lines if len(tree.query(l, predicate="covered_by")) == 0]
+
+def delete_tmp_files(paths):
+    """Unlink processed tmp files; list() consumes the map so errors surface."""
+    with ThreadPoolExecutor() as ex:
+        list(ex.map(Path.unlink, paths))
+
+def cascaded_union(geoms, chunk=200):
+    """Union geometries in two levels (chunks first, then the chunk results).
+    Much faster than one flat union_all on dense route sets."""
+    parts = [union_all(geoms[i:i + chunk]) for i in range(0, len(geoms), chunk)]
+    return union_all(parts)
+
+def lines_from_segments(segments):
+    """Build all LineStrings from per-segment coord arrays in a single C call."""
+    segments = [s for s in segments if len(s) > 1]
+    if not segments:
+        return []
+    coords = np.concatenate(segments)
+    indices = np.repeat(np.arange(len(segments)), [len(s) for s in segments])
+    return list(linestrings(coords, indices=indices))
+
 def gpx_to_lines(gpx_file):
-    with open(gpx_file, "r", encoding="utf-8") as f:
-        gpx = gpxpy.parse(f)
-    lines = []
-    for track in gpx.tracks:
-        for segment in track.segments:
-            coords = [(p.longitude, p.latitude) for p in segment.points]
-            if len(coords) > 1:
-                lines.append(LineString(coords))
-    return lines
+    return lines_from_segments(_stream_gpx(gpx_file))
 
 # one-time historical download function
 def import_historical_gpx(historical_dir):
@@ -63,30 +117,44 @@ def import_historical_gpx(historical_dir):
     gpx_files = [f for f in gpx_files if not any(act in f.name for act in EXCLUDE_ACTIVITIES)]
     print(f"Found {len(gpx_files)} historical GPX files.")
 
-    if EXISTING.exists():
-        gdf = gpd.read_file(EXISTING)
-    else:
-        gdf = gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
-
-    new_lines = []
-    for gpx in gpx_files:
-        new_lines.extend(gpx_to_lines(gpx))
+    # each file is independent, so fan the parsing out across all cores;
+    # workers ship back plain coord arrays (cheaper IPC than geometries)
+    # and all LineStrings are built in one vectorized constructor call
+    with ProcessPoolExecutor() as ex:
+        results = ex.map(_stream_gpx, gpx_files, chunksize=8)
+        segments = list(itertools.chain.from_iterable(results))
+    new_lines = lines_from_segments(segments)
 
     print(f"Extracted {len(new_lines)} lines from historical GPX files.")
 
     new_gdf = gpd.GeoDataFrame(geometry=new_lines, crs="EPSG:4326")
-    combined = pd.concat([gdf, new_gdf], ignore_index=True)
-    all_routes = gpd.GeoDataFrame(geometry=combined["geometry"], crs="EPSG:4326")
 
-    # merge overlapping lines
-    merged_geom = all_routes.buffer(0.00005).unary_union
-    merged_gdf = gpd.GeoDataFrame(geometry=[merged_geom], crs="EPSG:4326")
-    merged_gdf["geometry"] = merged_gdf["geometry"].apply(
-        lambda geom: geom.simplify(0.00005, preserve_topology=True)
-    )
+    # thin out the raw traces first — buffer/union cost scales with vertex count
+    new_gdf["geometry"] = simplify(new_gdf.geometry.values, tolerance=0.00005,
+                                   preserve_topology=False)
+
+    # union the lines directly (no buffer polygons) — shared segments are
+    # deduped and line_merge stitches the pieces back together
+    prev = load_merged_geom(rebuilding=True)
+    new_geoms = prune_covered(new_gdf.geometry.values, prev)
+    print(f"{len(new_geoms)} lines add new geometry.")
+    if new_geoms:
+        # pull near-coincident vertices together so repeat traces collapse
+        # onto shared segments instead of doubling them: first within the
+        # batch itself, then onto the existing map
+        new_geoms = list(snap(new_geoms, cascaded_union(new_geoms),
+                              tolerance=0.00005))
+        if prev is not None:
+            new_geoms = list(snap(new_geoms, prev, tolerance=0.00005))
+        new_union = cascaded_union(new_geoms)
+        merged_geom = union_all([prev, new_union]) if prev is not None else new_union
+        merged_geom = line_merge(merged_geom)
+    else:
+        merged_geom = prev
 
-    merged_gdf = merged_gdf.round(5)
-    merged_gdf.to_file(EXISTING, driver="GeoJSON")
+    merged_gdf = gpd.GeoDataFrame(geometry=[merged_geom], crs="EPSG:4326")
+    merged_gdf.to_parquet(EXISTING)
+    merged_gdf.to_file(GEOJSON, driver="GeoJSON")  # the map page still loads GeoJSON
 
     INFO_FILE.write_text(json.dumps({
         "last_update": datetime.now().isoformat(),
@@ -111,51 +179,18 @@ def download_new_gpx():
     last_update = get_last_update()
     print(f"Fetching activities since {last_update.date()}")
 
-    CHUNK_SIZE = 100
-    all_activities = []
-    offset = 0
-    reached_target_date = False
-
-    # Fetch in chunks until we reach activities older than last_update
-    while not reached_target_date:
-        print(f"Fetching activities {offset}–{offset + CHUNK_SIZE} ...")
-
-        try:
-            chunk = api.get_activities(offset, CHUNK_SIZE)
-        except Exception as e:
-            print(f"Error fetching chunk at offset {offset}: {e}")
-            break
-
-        if not chunk:
-            print("No more activities returned by API")
-            break
-
-        print(f"  Retrieved {len(chunk)} activities")
-
-        # Check the date of the oldest activity in this chunk
-        oldest_in_chunk = datetime.fromisoformat(
-            chunk[-1]["startTimeLocal"].replace("Z", "")
+    # one date-filtered call replaces the old chunked pagination scan
+    try:
+        all_activities = api.get_activities_by_date(
+            last_update.date().isoformat(), date.today().isoformat()
         )
-        print(f"  Oldest activity in chunk: {oldest_in_chunk.date()}")
-
-        all_activities.extend(chunk)
-
-        # Stop if gone past target date
-        if oldest_in_chunk <= last_update:
-            print(f"Reached target date {last_update.date()}")
-            reached_target_date = True
-            break
-
-        offset += CHUNK_SIZE
-
-        # Safety valve
-        if offset > 10000:
-            print("Safety limit reached (10,000 activities)")
-            break
+    except Exception as e:
+        print(f"Error fetching activities: {e}")
+        return []
 
     print(f"Total activities fetched: {len(all_activities)}")
 
-    # Filter to only activities newer than last update
+    # Filter to strictly newer than last update (the API filter is day-granular)
     new_acts = []
     for a in all_activities:
         act_date = datetime.fromisoformat(a["startTimeLocal"].replace("Z", ""))
@@ -165,81 +200,92 @@ def download_new_gpx():
     print(f"Activities after last update ({last_update.date()}): {len(new_acts)}")
 
     # Download GPX for activities that pass filters
-    new_files = []
-    download_count = 0
-
-    for i, a in enumerate(new_acts, 1):
+    def _dl(a):
+        """Download one activity's GPX; returns the saved path or None."""
         act_type = a["activityType"]["typeKey"]
 
         if act_type in EXCLUDE_ACTIVITIES:
-            continue
+            return None
 
         act_id = a["activityId"]
         act_date = a["startTimeLocal"][:10]
         filename = f"{act_date}_{act_type}_{act_id}.gpx"
         gpx_path = TMP_DIR / filename
 
-        if not gpx_path.exists():
-            print(f"⬇ [{i}/{len(new_acts)}] Downloading {act_type} on {act_date}")
-            try:
-                gpx_data = api.download_activity(
-                    act_id,
-                    dl_fmt=api.ActivityDownloadFormat.GPX
-                )
-                with open(gpx_path, "wb") as f:
-                    f.write(gpx_data)
-                new_files.append(gpx_path)
-                download_count += 1
-            except Exception as e:
-                print(f"  ⚠ Failed to download {act_id}: {e}")
-                continue
-
-    print(f"\n✓ Downloaded {download_count} new activities.")
+        if gpx_path.exists():
+            return None
+
+        print(f"⬇ Downloading {act_type} on {act_date}")
+        try:
+            gpx_data = api.download_activity(
+                act_id,
+                dl_fmt=api.ActivityDownloadFormat.GPX
+            )
+            with open(gpx_path, "wb") as f:
+                f.write(gpx_data)
+            return gpx_path
+        except Exception as e:
+            print(f"  ⚠ Failed to download {act_id}: {e}")
+            return None
+
+    # each download is a blocking HTTPS round-trip, so fan them out over threads
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        new_files = [p for p in ex.map(_dl, new_acts) if p is not None]
+
+    print(f"\n✓ Downloaded {len(new_files)} new activities.")
     return new_files
 
 def merge_routes(gpx_files):
     """Merge all new GPX routes into one GeoJSON"""
-    if EXISTING.exists():
-        gdf = gpd.read_file(EXISTING)
-    else:
-        gdf = gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
-
     new_lines = []
+    processed = []
     for gpx in gpx_files:
         new_lines.extend(gpx_to_lines(gpx))
-        gpx.unlink()  # delete after processing
+        processed.append(gpx)
 
     if not new_lines:
         print("No new GPX routes to merge.")
+        delete_tmp_files(processed)
         return 0
 
     new_gdf = gpd.GeoDataFrame(geometry=new_lines, crs="EPSG:4326")
-    combined = pd.concat([gdf, new_gdf], ignore_index=True)
-    all_routes = gpd.GeoDataFrame(geometry=combined["geometry"], crs="EPSG:4326")
 
-    # merge overlapping lines (buffer + dissolve)
-    merged_geom = all_routes.buffer(0.00005).unary_union
-    merged_gdf = gpd.GeoDataFrame(geometry=[merged_geom], crs="EPSG:4326")
-    merged_gdf["geometry"] = merged_gdf["geometry"].apply(
-        lambda geom: geom.simplify(0.00005, preserve_topology=True)
-    )
-
-    def round_coords(geom, ndigits=5):
-        if geom.is_empty:
-            return geom
-        return shapely.geometry.mapping(geom)
+    # thin out the raw traces first — buffer/union cost scales with vertex count
+    new_gdf["geometry"] = simplify(new_gdf.geometry.values, tolerance=0.00005,
+                                   preserve_topology=False)
+
+    # union the lines directly (no buffer polygons) — shared segments are
+    # deduped and line_merge stitches the pieces back together; work still
+    # scales with the update, not the whole history
+    prev = load_merged_geom()
+    new_geoms = prune_covered(new_gdf.geometry.values, prev)
+    print(f"{len(new_geoms)} lines add new geometry.")
+    if new_geoms:
+        # pull near-coincident vertices together so repeat traces collapse
+        # onto shared segments instead of doubling them: first within the
+        # batch itself, then onto the existing map
+        new_geoms = list(snap(new_geoms, cascaded_union(new_geoms),
+                              tolerance=0.00005))
+        if prev is not None:
+            new_geoms = list(snap(new_geoms, prev, tolerance=0.00005))
+        new_union = cascaded_union(new_geoms)
+        merged_geom = union_all([prev, new_union]) if prev is not None else new_union
+        merged_geom = line_merge(merged_geom)
+    else:
+        merged_geom = prev
 
-    merged_gdf = merged_gdf.round(5)
-    merged_gdf.to_file(
-        EXISTING,
-        driver="GeoJSON"
-    )
+    merged_gdf = gpd.GeoDataFrame(geometry=[merged_geom], crs="EPSG:4326")
+    merged_gdf.to_parquet(EXISTING)
+    merged_gdf.to_file(GEOJSON, driver="GeoJSON")  # the map page still loads GeoJSON
 
     INFO_FILE.write_text(json.dumps({
         "last_update": datetime.now().isoformat(),
         "routes_added": len(new_lines)
     }, indent=2))
 
+    # only delete sources once everything is written — a failed run keeps them
+    delete_tmp_files(processed)
+
     print(f"🗺 Map updated with {len(new_lines)} new lines.")
     return len(new_lines)
 
@@ -1,12 +1,13 @@
 """
 Parse GPX files in a directory to extract course information and save it as JSON.
-requires: gpxpy library (install via pip)
+requires: lxml and numpy libraries (install via pip)
 """
 import os
 import json
-import gpxpy
+import numpy as np
 import requests
 import time
+from lxml import etree
 
 
 def parse_args():
@@ -18,9 +19,32 @@ def parse_args():
     return parser.parse_args()
 
 
+# one pooled session so every Photon call reuses the same TCP+TLS connection
+SESSION = requests.Session()
+SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+# disk cache of geocode results — many courses start in the same city
+CACHE_FILE = os.path.join(os.path.dirname(__file__), "geocode_cache.json")
+
+
+def _load_geocode_cache():
+    if os.path.exists(CACHE_FILE):
+        with open(CACHE_FILE, "r", encoding="utf-8") as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                pass
+    return {}
+
+
+_GEOCODE_CACHE = _load_geocode_cache()
+
+
 def reverse_geocode_photon(lat, lon):
     """
     Reverse geocode using Photon API to get location name.
+    Results are cached on disk keyed by (lat, lon) rounded to ~1 km;
+    cache hits skip both the HTTP call and the politeness sleep.
     Args:
         lat (float): Latitude
         lon (float): Longitude
@@ -28,27 +52,67 @@ def reverse_geocode_photon(lat, lon):
     Returns:
         str: Location name (city or name) or "Unknown"
     """
+    key = f"{round(lat, 2)},{round(lon, 2)}"
+    if key in _GEOCODE_CACHE:
+        return _GEOCODE_CACHE[key]
+
     url = f"https://photon.komoot.io/reverse?lat={lat}&lon={lon}"
-    resp = requests.get(url, timeout=10)
-    if resp.ok:
-        data = resp.json()
-        if data["features"]:
-            props = data["features"][0]["properties"]
-            city = props.get("city") or props.get("name") or "Unknown"
-            # city = city.replace("ü", "ue").replace("Ü", "Ue")
-            return city
-    return "Unknown"
-
-
-def compute_elevation_gain(track):
+    resp = SESSION.get(url, timeout=10)
+    if not resp.ok:
+        # transient failure — don't cache it, so a later run retries
+        time.sleep(1)
+        return "Unknown"
+
+    city = "Unknown"
+    data = resp.json()
+    if data["features"]:
+        props = data["features"][0]["properties"]
+        city = props.get("city") or props.get("name") or "Unknown"
+        # city = city.replace("ü", "ue").replace("Ü", "Ue")
+
+    _GEOCODE_CACHE[key] = city
+    with open(CACHE_FILE, "w", encoding="utf-8") as f:
+        json.dump(_GEOCODE_CACHE, f, indent=2, ensure_ascii=False)
+    time.sleep(1)  # be polite to Photon (max 1 request/sec), misses only
+    return city
+
+
+def _stream_gpx(path):
+    """
+    Stream a GPX file with lxml's iterparse (C-level parsing, no object tree).
+
+    Returns:
+        list[np.ndarray]: one (N, 3) float array of (lon, lat, ele) per <trkseg>
+    """
+    segments = []
+    for _, seg in etree.iterparse(path, events=("end",), tag="{*}trkseg"):
+        pts = seg.findall("{*}trkpt")
+        arr = np.empty((len(pts), 3), dtype=np.float64)
+        for i, p in enumerate(pts):
+            arr[i, 0] = float(p.get("lon"))
+            arr[i, 1] = float(p.get("lat"))
+            ele = p.find("{*}ele")
+            arr[i, 2] = float(ele.text) if ele is not None else 0.0
+        seg.clear()  # free the element tree as we go
+        segments.append(arr)
+    return segments
+
+
+def _segment_length_m(seg):
+    """2D length of one (lon, lat, ele) segment array in meters (haversine)."""
+    lon = np.radians(seg[:, 0])
+    lat = np.radians(seg[:, 1])
+    a = (np.sin(np.diff(lat) / 2) ** 2
+         + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2)
+    return float((2 * 6371000 * np.arcsin(np.sqrt(a))).sum())
+
+
+def compute_elevation_gain(segments):
     """Compute total elevation gain (sum of positive elevation changes) in meters."""
     total_gain = 0.0
-    for segment in track.segments:
-        points = segment.points
-        for i in range(1, len(points)):
-            diff = points[i].elevation - points[i - 1].elevation
-            if diff > 0:
-                total_gain += diff
+    for seg in segments:
+        # one vectorized, branchless pass per segment
+        total_gain += float(np.maximum(np.diff(seg[:, 2]), 0.0).sum())
     return round(total_gain, 1)
 
 
@@ -68,34 +132,33 @@ def main(args):
     else:
         existing_data = []
 
-    # Index existing files by filename
-    existing_files = {os.path.basename(c["file"]): c for c in existing_data}
-    courses = existing_data.copy()
+    # Index courses by filename — O(1) skip checks and inserts
+    courses = {os.path.basename(c["file"]): c for c in existing_data}
 
-    for filename in os.listdir(gpx_dir):
-        if not filename.endswith(".gpx"):
-            continue
+    # scandir returns DirEntry objects with the path and stat info cached
+    with os.scandir(gpx_dir) as it:
+        entries = [e for e in it if e.name.endswith(".gpx")]
+
+    for entry in entries:
+        filename = entry.name
 
         # Skip files already processed
-        if filename in existing_files:
+        if filename in courses:
             print(f"Skipping existing: {filename}")
             continue
 
-        gpx_path = os.path.join(gpx_dir, filename)
+        gpx_path = entry.path
         print(f"Processing: {filename}")
 
         try:
-            with open(gpx_path, "r", encoding="utf-8") as f:
-                gpx = gpxpy.parse(f)
+            segments = _stream_gpx(gpx_path)
 
-            track = gpx.tracks[0]
-            segment = track.segments[0]
-            first_point = segment.points[0]
-            lat, lon = first_point.latitude, first_point.longitude
+            first_point = segments[0][0]
+            lat, lon = first_point[1], first_point[0]
 
             # Compute distance (sum of segment lengths)
-            distance_km = sum(seg.length_2d() for seg in track.segments) / 1000
-            el_gain = compute_elevation_gain(track)
+            distance_km = sum(_segment_length_m(seg) for seg in segments) / 1000
+            el_gain = compute_elevation_gain(segments)
             location = reverse_geocode_photon(lat, lon)
 
             course = {
@@ -105,10 +168,9 @@ def main(args):
                 "elevation_gain": el_gain,
                 "distance": round(distance_km, 1)
             }
-            courses.append(course)
+            courses[filename] = course
 
             print(f"Added: {course['name']} ({course['distance']} km, {course['location']})")
-            time.sleep(1)  # Be polite to Nominatim (max 1 request/sec)
 
         except Exception as e:
             print(f"Error processing {filename}: {e}")
@@ -116,13 +178,10 @@ def main(args):
     # Save updated list
     os.makedirs(os.path.dirname(output_json), exist_ok=True)
     with open(output_json, "w", encoding="utf-8") as f:
-        json.dump(courses, f, indent=2, ensure_ascii=False)
+        json.dump(list(courses.values()), f, indent=2, ensure_ascii=False)
 
     print(f"\nDone. Total entries: {len(courses)}")
 
-    with open(args.output, "w") as f:
-        json.dump(courses, f, indent=2)
-
 if __name__ == "__main__":
     args = parse_args()
     main(args)